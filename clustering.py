@@ -0,0 +1,140 @@
+"""Community detection on the mutual friends graph
+
+Used by the social graph to render accounts with thousands of friends as aggregated clusters
+"""
+from array import array
+from collections import Counter
+from random import Random
+
+
+def build_adjacency(uids, mutual):
+    """Builds an array-backed (CSR) adjacency of the mutual friends graph
+
+    :param uids: list of friends IDs, position in the list is the index of the vertex
+    :param mutual: dictionary with pairs of user id - list of mutual friends ids
+    :return: tuple of offsets and targets arrays, neighbours of vertex i are targets[offsets[i]:offsets[i + 1]]
+
+    example: uids=[1, 2, 3], mutual={1: [2], 2: [1, 3], 3: [2]} -> (array([0, 1, 3, 4]), array([1, 0, 2, 1]))
+    """
+
+    index = {uid: i for i, uid in enumerate(uids)}
+    neighbours = [set() for _ in uids]
+    for friend1, mutuals in mutual.items():
+        i = index.get(int(friend1))
+        if i is None or not mutuals:
+            continue
+        for friend2 in mutuals:
+            j = index.get(int(friend2))
+            if j is not None and j != i:
+                neighbours[i].add(j)
+                neighbours[j].add(i)
+
+    offsets = array('l', [0])
+    targets = array('l')
+    for adjacent in neighbours:
+        targets.extend(sorted(adjacent))
+        offsets.append(len(targets))
+    return offsets, targets
+
+
+def label_propagation(offsets, targets, max_iterations=20, seed=10):
+    """Splits the graph into communities by the label propagation algorithm
+
+    :param offsets: offsets array of the CSR adjacency
+    :param targets: targets array of the CSR adjacency
+    :param max_iterations: upper bound on the number of passes over all vertices
+    :param seed: random seed, makes the result reproducible between renders
+    :return: array of labels, vertices with the same label belong to the same community
+    """
+
+    vertices_count = len(offsets) - 1
+    labels = array('l', range(vertices_count))
+    order = list(range(vertices_count))
+    rnd = Random(seed)
+
+    for _ in range(max_iterations):
+        rnd.shuffle(order)
+        changed = False
+        for v in order:
+            start, end = offsets[v], offsets[v + 1]
+            if start == end:
+                continue
+            counts = Counter(labels[u] for u in targets[start:end])
+            best = max(counts.values())
+            if counts.get(labels[v]) == best:
+                continue
+            labels[v] = rnd.choice([label for label, count in counts.items() if count == best])
+            changed = True
+        if not changed:
+            break
+    return labels
+
+
+def get_clusters(uids, mutual, min_cluster_size=3):
+    """Returns communities of friends, largest first
+
+    Communities smaller than min_cluster_size (including friends without mutual friends)
+    are merged into the last, residual cluster
+
+    :param uids: list of friends IDs
+    :param mutual: dictionary with pairs of user id - list of mutual friends ids
+    :param min_cluster_size: minimal size of a standalone community
+    :return: list of lists of friends IDs
+
+    example: [[friend_id1, friend_id2, ...], ..., [friend_id9, friend_id10]]
+    """
+
+    offsets, targets = build_adjacency(uids, mutual)
+    labels = label_propagation(offsets, targets)
+
+    communities = {}
+    for uid, label in zip(uids, labels):
+        communities.setdefault(label, []).append(uid)
+
+    clusters = []
+    residual = []
+    for members in sorted(communities.values(), key=len, reverse=True):
+        if len(members) >= min_cluster_size:
+            clusters.append(members)
+        else:
+            residual.extend(members)
+    if residual:
+        clusters.append(residual)
+    return clusters
+
+
+def aggregate_edges(edges, cluster_of, directed):
+    """Replaces the ends of the edges with their clusters and sums the weights of the resulting parallel edges
+
+    :param edges: list of edges between users, tuples (from id, to id, weight)
+    :param cluster_of: dictionary with pairs of friend id - id of the cluster node, the ends missing in it are kept as is
+    :param directed: whether edges from a to b and from b to a are different
+    :return: list of aggregated edges in the same format, edges inside one cluster are dropped
+    """
+
+    aggregated = {}
+    for source, target, value in edges:
+        source = cluster_of.get(source, source)
+        target = cluster_of.get(target, target)
+        if source == target:
+            continue
+        key = (source, target) if directed else (min(source, target), max(source, target))
+        aggregated[key] = aggregated.get(key, 0) + value
+    return [(source, target, value) for (source, target), value in aggregated.items()]
+
+
+def split_edges(edges, cluster_of):
+    """Groups edges by the clusters of their ends, an edge between two clusters gets into both groups
+
+    :param edges: list of edges between users, tuples (from id, to id, weight)
+    :param cluster_of: dictionary with pairs of friend id - id of the cluster node
+    :return: dict of cluster node ids and lists of edges incident to its friends
+
+    example: {-1: [(friend_id1, friend_id2, weight), (uid, friend_id1, weight), ...], -2: [...], ...}
+    """
+
+    groups = {}
+    for edge in edges:
+        for cluster_id in {cluster_of.get(edge[0]), cluster_of.get(edge[1])} - {None}:
+            groups.setdefault(cluster_id, []).append(edge)
+    return groups
@@ -0,0 +1,235 @@
+"""Crawling of the VK social graph beyond the friends of the user"""
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+from django.db import transaction
+
+from .models import VKCrawl, VKCrawlNode, VKCrawlEdge
+from .extractors.vk_extractor import get_friends_lists
+
+
+class VisitedSet:
+    """Compact set of users IDs: sorted array of IDs and a small buffer of recently added ones"""
+
+    buffer_size = 4096
+
+    def __init__(self, data=b''):
+        """
+        :param data: bytes returned by tobytes, to restore the set of a paused crawl
+        """
+
+        self._ids = array('Q')
+        self._ids.frombytes(data)
+        self._buffer = set()
+
+    def __contains__(self, uid):
+        if uid in self._buffer:
+            return True
+        i = bisect_left(self._ids, uid)
+        return i < len(self._ids) and self._ids[i] == uid
+
+    def __len__(self):
+        return len(self._ids) + len(self._buffer)
+
+    def add(self, uid):
+        if uid in self:
+            return
+        self._buffer.add(uid)
+        if len(self._buffer) >= self.buffer_size:
+            self._merge()
+
+    def _merge(self):
+        if self._buffer:
+            self._ids = array('Q', sorted(chain(self._ids, self._buffer)))
+            self._buffer.clear()
+
+    def tobytes(self):
+        self._merge()
+        return self._ids.tobytes()
+
+
+class VKCrawler:
+    """Crawler expanding the VK social graph from the seed user to friends of friends
+
+    Friends of the seed are crawled in the order of the number of mutual friends and interactions with the seed,
+    farther users in the order of discovery (the frontier is a heap of (-priority, depth, discovery number, id)).
+    Found users and friendships are saved after every step,
+    the state of the crawl every checkpoint_steps steps and when run stops, so the crawl can be paused
+    and resumed by creating a crawler for the same VKCrawl. Steps made after the last checkpoint are repeated
+    on resume, their users and friendships are not saved twice
+    """
+
+    batch_size = 25  # friends lists of 25 users are requested in one execute call
+    frontier_size = 50000
+    flush_size = 5000
+    checkpoint_steps = 20
+
+    def __init__(self, crawl, token_pool):
+        """
+        :param crawl: VKCrawl model with the state of the crawl
+        :param token_pool: pool of tokens to spread requests between
+        """
+
+        self.crawl = crawl
+        self.token_pool = token_pool
+        self.visited = VisitedSet(bytes(crawl.visited))
+        self.frontier = [tuple(item) for item in crawl.frontier]
+        heapq.heapify(self.frontier)
+        self._nodes = []
+        self._edges = []
+        self._steps = 0
+
+    @classmethod
+    def start(cls, seed, token_pool, max_depth=2, max_nodes=100000, max_requests=1000):
+        """Creates a crawl from the seed user and his friends
+        :param seed: VKUser model with friends list
+        :param token_pool: pool of tokens to spread requests between
+        :param max_depth: distance from the seed up to which users are found
+        :param max_nodes: maximum number of found users
+        :param max_requests: maximum number of requests to VK API
+        :return: crawler for the new crawl
+        """
+
+        crawl = VKCrawl(seed=seed, max_depth=max_depth, max_nodes=max_nodes, max_requests=max_requests)
+        crawler = cls(crawl, token_pool)
+        with transaction.atomic():
+            crawl.save()
+            crawler._add_node(seed.id_vk, 0, {'first_name': seed.first_name, 'last_name': seed.last_name,
+                                              'photo_200': seed.image_url})
+            crawler._add_friends(seed.id_vk, 0, seed.friends.get('items'))
+            crawler.checkpoint()
+        return crawler
+
+    def run(self, max_steps=None):
+        """Crawls until the frontier or the budget is exhausted or max_steps steps are made,
+        saves the state of the crawl when stopped
+        """
+
+        steps = 0
+        try:
+            while (max_steps is None or steps < max_steps) and self.step():
+                steps += 1
+        finally:
+            self.checkpoint()
+
+    def step(self):
+        """Crawls friends lists of the next users of the frontier, one execute request per token
+        :return: False if the crawl is finished
+        """
+
+        crawl = self.crawl
+        if crawl.is_finished:
+            return False
+        if not self.frontier or crawl.requests_count >= crawl.max_requests:
+            crawl.is_finished = True
+            self.checkpoint()
+            return False
+
+        requests_count = min(max(self.token_pool.size('friends.get'), 1), crawl.max_requests - crawl.requests_count)
+        batches = []
+        for _ in range(requests_count):
+            batch = [heapq.heappop(self.frontier) for _ in range(min(self.batch_size, len(self.frontier)))]
+            if batch:
+                batches.append(batch)
+
+        try:
+            friends_lists = list(self.token_pool.map('friends.get', self._get_friends_lists, batches))
+        except BaseException:
+            # popped users are already visited, they would never get into the frontier again
+            for entry in chain.from_iterable(batches):
+                heapq.heappush(self.frontier, entry)
+            raise
+        with transaction.atomic():
+            for batch, response in zip(batches, friends_lists):
+                for _, depth, _, uid in batch:
+                    friends = response.get(uid) or response.get(str(uid))
+                    if friends:
+                        self._add_friends(uid, depth, friends.get('items'))
+            self._flush()
+        crawl.requests_count += len(batches)
+        self._steps += 1
+        if self._steps >= self.checkpoint_steps:
+            self.checkpoint()
+        return True
+
+    def _get_friends_lists(self, vk_session, batch):
+        response, errors = get_friends_lists(vk_session, [uid for _, _, _, uid in batch])
+        self.token_pool.report_errors(vk_session, 'friends.get', errors.values())
+        return response
+
+    def _add_friends(self, uid, depth, friends):
+        """Saves found friends of the crawled user and adds the ones to crawl further to the frontier"""
+
+        for friend in friends:
+            friend_id = friend.get('id')
+            if friend_id not in self.visited and len(self.visited) < self.crawl.max_nodes:
+                self._add_node(friend_id, depth + 1, friend)
+                if depth + 1 < self.crawl.max_depth and not ('deactivated' in friend or friend.get('is_closed')):
+                    self._push(self._get_priority(friend_id, depth + 1), depth + 1, friend_id)
+            if friend_id not in self.visited:
+                # friendships are stored only between found users
+                continue
+            # a friendship is found from both ends, it is stored once as the pair of ordered ids
+            self._edges.append(VKCrawlEdge(crawl=self.crawl, source=min(uid, friend_id), target=max(uid, friend_id)))
+            if len(self._edges) >= self.flush_size:
+                self._flush()
+
+    def _add_node(self, uid, depth, profile):
+        self.visited.add(uid)
+        self._nodes.append(VKCrawlNode(
+            crawl=self.crawl,
+            uid=uid,
+            depth=depth,
+            first_name=profile.get('first_name'),
+            last_name=profile.get('last_name'),
+            image_url=profile.get('photo_200'),
+        ))
+        if len(self._nodes) >= self.flush_size:
+            self._flush()
+
+    def _get_priority(self, uid, depth):
+        """Returns priority of the user: for friends of the seed it is the number of mutual friends
+        and interactions with the seed, farther users have the lowest priority
+        """
+
+        if depth > 1:
+            return 0
+        seed = self.crawl.seed
+        priority = len(_get_by_uid(seed.friends_mutual, uid) or [])
+        for metric in (seed.friends_gifts, seed.friends_likes, seed.friends_comments):
+            priority += (_get_by_uid(_get_by_uid(metric, uid), seed.id_vk) or 0)
+            priority += (_get_by_uid(_get_by_uid(metric, seed.id_vk), uid) or 0)
+        return priority
+
+    def _push(self, priority, depth, uid):
+        # the number of found users is the discovery number of the just found one, it orders equal priorities
+        heapq.heappush(self.frontier, (-priority, depth, len(self.visited), uid))
+        if len(self.frontier) > 2 * self.frontier_size:
+            self.frontier = heapq.nsmallest(self.frontier_size, self.frontier)
+
+    def _flush(self):
+        VKCrawlNode.objects.bulk_create(self._nodes, ignore_conflicts=True)
+        VKCrawlEdge.objects.bulk_create(self._edges, ignore_conflicts=True)
+        self._nodes = []
+        self._edges = []
+
+    def checkpoint(self):
+        """Saves found users, friendships and the state of the crawl"""
+
+        with transaction.atomic():
+            self._flush()
+            self.crawl.frontier = self.frontier
+            self.crawl.visited = self.visited.tobytes()
+            self.crawl.nodes_count = len(self.visited)
+            self.crawl.save()
+        self._steps = 0
+
+
+def _get_by_uid(data, uid):
+    """Returns value by user id from a JSONField dict, whose keys become strings after loading from the database"""
+
+    if not data:
+        return None
+    return data.get(uid, data.get(str(uid)))
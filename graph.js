@@ -3,11 +3,43 @@ try {
     require('vis-network');
 } catch (e) { }
 
-function drawGraph(pNodes, pEdges, options, elementId) {
+// Replaces the ends of the edges with their collapsed clusters and sums the weights of parallel edges
+function aggregateEdges(clusterEdges, clusterOf, directed) {
+    var aggregated = {};
+    clusterEdges.forEach(function (edge) {
+        var from = clusterOf[edge[0]] || edge[0];
+        var to = clusterOf[edge[1]] || edge[1];
+        if (!directed && from > to) {
+            var end = from;
+            from = to;
+            to = end;
+        }
+        var key = from + ">" + to;
+        if (key in aggregated) {
+            aggregated[key].value += edge[2];
+        } else {
+            aggregated[key] = {from: from, to: to, value: edge[2]};
+        }
+    });
+    return Object.values(aggregated);
+}
+
+function drawGraph(pNodes, pEdges, options, elementId, clusters, clusterEdges, directed) {
     // parsing and collecting nodes and edges from the python
     var nodes = new vis.DataSet(pNodes);
     var edges = new vis.DataSet(pEdges);
     var container = document.getElementById(elementId);
+    var userId = pNodes[0].id;
+
+    // friends in collapsed clusters, friend id -> cluster node id
+    clusters = clusters || {};
+    clusterEdges = clusterEdges || {};
+    var clusterOf = {};
+    for (var clusterId in clusters) {
+        clusters[clusterId].forEach(function (friend) {
+            clusterOf[friend[0]] = Number(clusterId);
+        });
+    }
 
     // adding nodes and edges to the graph
     var data = {nodes: nodes,
@@ -22,8 +54,41 @@ function drawGraph(pNodes, pEdges, options, elementId) {
       network.fit({animation: options});
     }, 1000);
 
+    // replaces the cluster node with its friends and their edges
+    function expandCluster(clusterId) {
+        edges.update(pEdges);
+        clusters[clusterId].forEach(function (friend) {
+            delete clusterOf[friend[0]];
+        });
+        nodes.remove(clusterId);
+        nodes.add(clusters[clusterId].map(function (friend) {
+            return {id: friend[0], label: friend[1], title: friend[2], image: friend[3],
+                    shape: "dot", color: "#007bff", size: 15};
+        }));
+        edges.remove(edges.getIds({filter: function (edge) {
+            return edge.from == clusterId || edge.to == clusterId;
+        }}));
+        edges.add(aggregateEdges(clusterEdges[clusterId] || [], clusterOf, directed).map(function (edge) {
+            var byUser = edge.from == userId || edge.to == userId;
+            edge.color = byUser ? "#FF7092" : "#007bff";
+            if (directed) {
+                edge.arrows = byUser ? "middle" : "to";
+            }
+            edge.title = "от: " + nodes.get(edge.from).title + "\nк:   " + nodes.get(edge.to).title;
+            return edge;
+        }));
+        delete clusters[clusterId];
+        pEdges = edges.get();
+    }
+
     network.on("click", function (params) {
-        if (params.nodes.length > 0) {
+        if (params.nodes.length > 0 && params.nodes[0] in clusters) {
+            var networkInfo = document.getElementById("networkInfo");
+            networkInfo.innerText = "Выбрана вершина \n" + nodes.get(params.nodes[0]).title + "\nНажмите на вершину два раза, чтобы раскрыть группу.";
+            nodeImage.removeAttribute("src");
+            nodeHref.style.display = 'none';
+        }
+        else if (params.nodes.length > 0) {
             var nodeId = params.nodes[0];
             var networkInfo = document.getElementById("networkInfo");
             networkInfo.innerText = "Выбрана вершина \nid: " + nodeId + "\n" + nodes.get(nodeId).title;
@@ -41,6 +106,10 @@ function drawGraph(pNodes, pEdges, options, elementId) {
     });
 
     network.on("doubleClick", function (params) {
+        if (params.nodes.length > 0 && params.nodes[0] in clusters) {
+            expandCluster(params.nodes[0]);
+            return;
+        }
         edges.update(pEdges);
         if (params.nodes.length > 0) {
             var allEdges = edges.get({ returnType: "Object" });
@@ -43,6 +43,8 @@ class UserBase(models.Model):
 
 class VKUser(UserBase):
     """VK user"""
+    friends_mutual = models.JSONField('Общие друзья', null=True)
+    friends_mutual_complete = models.BooleanField('Общие друзья получены полностью', default=False)
 
     class Meta:
         verbose_name = 'Пользователь ВК'
@@ -103,6 +105,53 @@ class VKUser(UserBase):
         self.save()
 
 
+class VKCrawl(models.Model):
+    """Crawl of the VK social graph from the seed user to friends of friends"""
+    seed = models.ForeignKey(VKUser, verbose_name='Исходный пользователь', on_delete=models.CASCADE, related_name='crawls')
+    max_depth = models.PositiveSmallIntegerField('Глубина обхода', default=2)
+    max_nodes = models.PositiveIntegerField('Ограничение числа пользователей', default=100000)
+    max_requests = models.PositiveIntegerField('Ограничение числа запросов', default=1000)
+    requests_count = models.PositiveIntegerField('Число запросов', default=0)
+    nodes_count = models.PositiveIntegerField('Число найденных пользователей', default=0)
+    frontier = models.JSONField('Очередь обхода', default=list)
+    visited = models.BinaryField('Найденные пользователи', default=bytes)
+    is_finished = models.BooleanField('Обход завершен', default=False)
+
+    def __str__(self):
+        return f'{self.seed} ({self.nodes_count})'
+
+    class Meta:
+        verbose_name = 'Обход графа ВК'
+        verbose_name_plural = 'Обходы графа ВК'
+
+
+class VKCrawlNode(models.Model):
+    """VK user found by the crawl"""
+    crawl = models.ForeignKey(VKCrawl, on_delete=models.CASCADE, related_name='nodes')
+    uid = models.PositiveBigIntegerField('Идентификатор')
+    depth = models.PositiveSmallIntegerField('Расстояние от исходного пользователя')
+    first_name = models.CharField('Имя пользователя', max_length=50, null=True)
+    last_name = models.CharField('Фамилия пользователя', max_length=50, null=True)
+    image_url = models.CharField('Аватар', max_length=200, null=True)
+
+    class Meta:
+        verbose_name = 'Пользователь обхода ВК'
+        verbose_name_plural = 'Пользователи обхода ВК'
+        unique_together = ('crawl', 'uid')
+
+
+class VKCrawlEdge(models.Model):
+    """Friendship found by the crawl, source is the smaller of the two ids"""
+    crawl = models.ForeignKey(VKCrawl, on_delete=models.CASCADE, related_name='edges')
+    source = models.PositiveBigIntegerField('Первый пользователь')
+    target = models.PositiveBigIntegerField('Второй пользователь')
+
+    class Meta:
+        verbose_name = 'Связь обхода ВК'
+        verbose_name_plural = 'Связи обхода ВК'
+        unique_together = ('crawl', 'source', 'target')
+
+
 class OKUser(UserBase):
     """OK user"""
 
@@ -1,14 +1,20 @@
 """Creating context for display at user request"""
+import os
+
+from django.conf import settings
+
 from .exceptions import InvalidTokenError
 from .extractors.exceptions import UserIdError, ApiRequestError
 from .models import VKUser, OKUser
 from .tokens.tokens import VKSocialToken, OKSocialToken
 from .dbqueries import get_ok_app_secret_key, get_ok_app_key
-from .extractors.vk_extractor import get_mutual_friends as vk_get_mutual, FriendsStatistics
+from .extractors.vk_extractor import MutualFriendsFetcher, FriendsStatistics
+from .extractors.token_pool import TokenPool
 from .extractors.ok_extractor import get_mutual_friends as ok_get_mutual
 from .forms import VKUserForm, OKUserForm
 from .profiles_matching.prediction import get_predict
 from .friends_graph.visualization import SocialGraph
+from .friends_graph.snapshot import load_snapshot
 
 
 def get_compare_context(request):
@@ -71,7 +77,7 @@ def get_analyze_context(request, network):
 def _get_vk_analyze_context(request):
     """Returns VK context for search page"""
 
-    profile = graph = None
+    profile = graph = coverage = None
 
     token = VKSocialToken(request.user)
     errors = []
@@ -84,24 +90,15 @@ def _get_vk_analyze_context(request):
                 if uid.isdigit():
                     uid = int(uid)
                 profile = VKUser.get_user(token.token, uid)
-                active_friends_ids = list(friend.get('id') for friend in profile.friends.get('items') if not('deactivated' in friend or friend.get('is_closed')))
-                mutual = vk_get_mutual(token.token, profile.id_vk, active_friends_ids)
-                friend_uids = list(friend.get('id') for friend in profile.friends.get('items'))
-                stats = FriendsStatistics(token.token, profile.id_vk, active_friends_ids, friend_uids)
-                if profile.friends_gifts:
-                    gifts = profile.friends_gifts
-                else:
-                    gifts = profile.friends_gifts = stats.get_gifts()
-                if profile.friends_likes:
-                    likes = profile.friends_likes
+                snapshot_path = _get_snapshot_path('vk', profile.id_vk)
+                snapshot = _load_fresh_snapshot(snapshot_path)
+                if snapshot is not None:
+                    graph = SocialGraph.from_snapshot(profile, snapshot)
                 else:
-                    likes = profile.friends_likes = stats.get_likes()
-                if profile.friends_comments:
-                    comments = profile.friends_comments
-                else:
-                    comments = profile.friends_comments = stats.get_comments()
-                profile.save()
-                graph = SocialGraph(profile, friend_uids, mutual, gifts, likes, comments)
+                    graph, coverage = _build_vk_graph(token.token, profile)
+                    # a partial graph is not stored, the next analysis fetches the missing mutual friends
+                    if snapshot_path and not coverage['failed']:
+                        graph.export_snapshot(snapshot_path)
             else:
                 for es in vk_form.errors.values():
                     errors.extend(error for error in es)
@@ -119,11 +116,75 @@ def _get_vk_analyze_context(request):
         'vk_token': token,
         'profile': profile,
         'graph': graph,
+        'coverage': coverage,
         'error': errors
     }
     return context
 
 
+def _build_vk_graph(token, profile):
+    """Requests mutual friends and statistics of the user's friends and builds his social graph
+    :return: tuple of SocialGraph and coverage of mutual friends
+    """
+
+    active_friends_ids = list(friend.get('id') for friend in profile.friends.get('items') if not('deactivated' in friend or friend.get('is_closed')))
+    token_pool = TokenPool([token] + getattr(settings, 'VK_POOL_USER_TOKENS', []),
+                           getattr(settings, 'VK_SERVICE_TOKENS', []))
+    # a completed fetch is not reused, only an interrupted one is resumed
+    fetched_mutual = None if profile.friends_mutual_complete else profile.friends_mutual
+    fetcher = MutualFriendsFetcher(token, profile.id_vk, active_friends_ids, fetched_mutual,
+                                   token_pool=token_pool)
+    profile.friends_mutual_complete = False
+    for _ in fetcher:
+        profile.friends_mutual = fetcher.mutual_friends
+        profile.save(update_fields=['friends_mutual', 'friends_mutual_complete'])
+    coverage = fetcher.coverage
+    profile.friends_mutual = fetcher.mutual_friends
+    profile.friends_mutual_complete = not coverage['failed']
+    profile.save(update_fields=['friends_mutual', 'friends_mutual_complete'])
+    mutual = {uid: fetcher.mutual_friends[uid] for uid in active_friends_ids if uid in fetcher.mutual_friends}
+    friend_uids = list(friend.get('id') for friend in profile.friends.get('items'))
+    stats = FriendsStatistics(token, profile.id_vk, active_friends_ids, friend_uids, token_pool)
+    if profile.friends_gifts:
+        gifts = profile.friends_gifts
+    else:
+        gifts = profile.friends_gifts = stats.get_gifts()
+    if profile.friends_likes:
+        likes = profile.friends_likes
+    else:
+        likes = profile.friends_likes = stats.get_likes()
+    if profile.friends_comments:
+        comments = profile.friends_comments
+    else:
+        comments = profile.friends_comments = stats.get_comments()
+    profile.save()
+    graph = SocialGraph(profile, friend_uids, mutual, gifts, likes, comments)
+    return graph, coverage
+
+
+def _get_snapshot_path(network, uid):
+    """Returns path of the graph snapshot of the user, None if snapshots are disabled"""
+
+    snapshots_dir = getattr(settings, 'GRAPH_SNAPSHOTS_DIR', None)
+    if snapshots_dir:
+        return os.path.join(snapshots_dir, network, str(uid))
+
+
+def _load_fresh_snapshot(path):
+    """Returns the graph snapshot if it is younger than GRAPH_SNAPSHOTS_TTL seconds, otherwise None"""
+
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        snapshot = load_snapshot(path)
+    except (OSError, ValueError):
+        # snapshot of an older format or removed meanwhile is rebuilt
+        return None
+    if snapshot.created is None or snapshot.age > getattr(settings, 'GRAPH_SNAPSHOTS_TTL', 24 * 60 * 60):
+        return None
+    return snapshot
+
+
 def _get_ok_analyze_context(request):
     """Returns OK context for search page"""
 
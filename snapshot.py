@@ -0,0 +1,184 @@
+"""Binary snapshots of analysed social graphs
+
+Snapshot is a directory of .npy arrays, which are loaded memory-mapped, without copying and parsing:
+    nodes.npy - IDs of the user (first) and his friends
+    first_names.npy, last_names.npy, images.npy - display fields of the nodes, in the order of nodes
+    mutual_indptr.npy, mutual_indices.npy - CSR adjacency of mutual friends, indices point into nodes
+    <layer>_indptr.npy, <layer>_indices.npy, <layer>_weights.npy - CSR matrix of gifts, likes or comments,
+        row is the receiver, column is the sender
+    meta.json - version of the format and creation time
+
+The path of the snapshot is a symlink to the directory with the arrays, a new snapshot is written next to it
+and the symlink is replaced atomically, so readers see either the previous or the new snapshot
+"""
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+LAYERS = ('gifts', 'likes', 'comments')
+DISPLAY_FIELDS = ('first_name', 'last_name', 'image')
+
+
+def save_snapshot(path, nodes, mutual, gifts, likes, comments):
+    """Writes snapshot of the graph, replacing the previous one
+
+    :param path: path of the snapshot
+    :param nodes: list of the user (first) and his friends, dicts with id, first_name, last_name and image
+    :param mutual: dictionary with pairs of user id - list of mutual friends ids
+    :param gifts: dict of incidents in FriendsStatistics format
+    :param likes: dict of incidents in FriendsStatistics format
+    :param comments: dict of incidents in FriendsStatistics format
+    """
+
+    index = {int(node['id']): i for i, node in enumerate(nodes)}
+
+    arrays = {'nodes': np.array([int(node['id']) for node in nodes], dtype=np.int64)}
+    for field in DISPLAY_FIELDS:
+        arrays[field + 's'] = np.array([node.get(field) or '' for node in nodes], dtype=np.str_)
+    indptr, indices, _ = _to_csr(index, {uid: {friend: 1 for friend in mutuals or []} for uid, mutuals in mutual.items()})
+    arrays['mutual_indptr'], arrays['mutual_indices'] = indptr, indices
+    for layer, metric in zip(LAYERS, (gifts, likes, comments)):
+        arrays[f'{layer}_indptr'], arrays[f'{layer}_indices'], arrays[f'{layer}_weights'] = _to_csr(index, metric or {})
+
+    directory, name = os.path.split(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    data_path = tempfile.mkdtemp(dir=directory, prefix=name + '.')
+    try:
+        for array_name, array in arrays.items():
+            np.save(os.path.join(data_path, array_name + '.npy'), array)
+        with open(os.path.join(data_path, 'meta.json'), 'w') as meta:
+            json.dump({'version': SNAPSHOT_VERSION, 'created': time.time()}, meta)
+        _swap(path, data_path)
+    except BaseException:
+        shutil.rmtree(data_path, ignore_errors=True)
+        raise
+
+
+def _swap(path, data_path):
+    """Points the symlink path to the data directory atomically and removes the directory it pointed to before
+
+    Concurrent writers swap under a lock, so each of them removes exactly the directory it has replaced
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    # the name of the data directory is unique, so is the name of the new symlink
+    link_path = data_path + '.link'
+    os.symlink(os.path.basename(data_path), link_path)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        previous_path = os.path.join(directory, os.readlink(path)) if os.path.islink(path) else None
+        try:
+            os.replace(link_path, path)
+        except OSError:
+            os.unlink(link_path)
+            raise
+        if previous_path:
+            shutil.rmtree(previous_path, ignore_errors=True)
+
+
+def _to_csr(index, rows):
+    """Converts dict of dicts {row id: {column id: weight}} to CSR arrays, IDs missing in index are skipped"""
+
+    row_items = [[] for _ in index]
+    for row_id, columns in rows.items():
+        row = index.get(int(row_id))
+        if row is None:
+            continue
+        for column_id, weight in columns.items():
+            column = index.get(int(column_id))
+            if column is not None and weight:
+                row_items[row].append((column, weight))
+
+    indptr = np.zeros(len(index) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(items) for items in row_items])
+    items = [item for items in row_items for item in sorted(items)]
+    indices = np.array([column for column, _ in items], dtype=np.int32)
+    weights = np.array([weight for _, weight in items], dtype=np.int32)
+    return indptr, indices, weights
+
+
+def load_snapshot(path):
+    """Maps snapshot into memory
+
+    :param path: path of the snapshot
+    :return: GraphSnapshot with read-only memory-mapped arrays
+    """
+
+    # the symlink is resolved once, so all files are read from the same version even if it is replaced meanwhile
+    path = os.path.realpath(path)
+    with open(os.path.join(path, 'meta.json')) as meta:
+        meta = json.load(meta)
+    version = meta.get('version')
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f'Неподдерживаемая версия снимка графа: {version}')
+    arrays = {
+        name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+        for name in os.listdir(path) if name.endswith('.npy')
+    }
+    return GraphSnapshot(arrays, meta.get('created'))
+
+
+class GraphSnapshot:
+    """Arrays of the graph snapshot and their conversion back to the analysis format"""
+
+    def __init__(self, arrays, created=None):
+        self.arrays = arrays
+        self.nodes = arrays['nodes']
+        self.created = created
+
+    @property
+    def age(self):
+        """Seconds since the snapshot was written"""
+
+        return time.time() - self.created
+
+    @property
+    def user_uid(self):
+        return int(self.nodes[0])
+
+    @property
+    def friend_uids(self):
+        return self.nodes[1:].tolist()
+
+    def get_nodes(self):
+        """Returns the user (first) and his friends, dicts with id, first_name, last_name and image"""
+
+        columns = [self.nodes.tolist()] + [self.arrays[field + 's'].tolist() for field in DISPLAY_FIELDS]
+        return [dict(zip(('id',) + DISPLAY_FIELDS, values)) for values in zip(*columns)]
+
+    def csr(self, layer):
+        """Returns indptr, indices and weights arrays of the layer ('mutual' has no weights)"""
+
+        return (
+            self.arrays[f'{layer}_indptr'],
+            self.arrays[f'{layer}_indices'],
+            self.arrays.get(f'{layer}_weights'),
+        )
+
+    def get_mutual(self):
+        """Returns dictionary with pairs of user id - list of mutual friends ids"""
+
+        indptr, indices, _ = self.csr('mutual')
+        nodes = self.nodes
+        return {
+            int(nodes[row]): nodes[indices[indptr[row]:indptr[row + 1]]].tolist()
+            for row in range(len(nodes)) if indptr[row] < indptr[row + 1]
+        }
+
+    def get_metric(self, layer):
+        """Returns dict of incidents of the layer in FriendsStatistics format"""
+
+        indptr, indices, weights = self.csr(layer)
+        nodes = self.nodes
+        metric = {}
+        for row in range(len(nodes)):
+            start, end = indptr[row], indptr[row + 1]
+            if start < end:
+                metric[int(nodes[row])] = dict(zip(nodes[indices[start:end]].tolist(), weights[start:end].tolist()))
+        return metric
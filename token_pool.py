@@ -0,0 +1,174 @@
+"""
+Pool of VK access tokens
+
+Spreads requests of one analysis between several tokens, each of them is limited by its own rate limit
+read https://vk.com/dev/api_requests
+
+Walls, gifts and friends lists of a user are shown depending on who is looking at them, so methods reading them
+(viewer_methods) are sent only with the analyst's own token, the first of the user tokens. Other user tokens
+and service tokens serve the rest of the methods
+
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import vk_api
+from .exceptions import ApiRequestError
+
+
+class _TokenSlot:
+    """Access token with its session and state"""
+
+    def __init__(self, token, kind, interval):
+        self.token = token
+        self.kind = kind
+        self.interval = interval
+        self.session = vk_api.VkApi(token=token)
+        self.session.RPS_DELAY = interval  # the library's own delay is tuned for user tokens
+        self.busy = False
+        self.disabled = False
+        self.available_at = 0
+        self.cooling_until = {}  # method -> time until which the method is not called with the token
+
+
+class TokenPool:
+    """Class for spreading VK API requests between user and service access tokens"""
+
+    user_interval = 1 / 3  # user token is allowed 3 requests per second
+    service_interval = 1 / 20  # service token is allowed 20 requests per second
+    # results of these methods depend on the viewer's access to the profiles, only the own token is used
+    viewer_methods = {'friends.getMutual', 'gifts.get', 'wall.get', 'likes.getList', 'wall.getComments'}
+    user_only_methods = {'friends.getMutual', 'gifts.get'}
+    disabling_error_codes = {5}  # authorization failed, the token is revoked or expired
+    # cooldown of the method for the token in seconds: flood control, daily rate limit of the method
+    cooling_error_codes = {9: 10, 29: 60 * 60}
+    max_wait = 30  # a call waits for a cooling method if the cooldown ends within this number of seconds
+    max_attempts = 5
+
+    def __init__(self, user_tokens, service_tokens=()):
+        """
+        :param user_tokens: list of user access tokens, the analyst's own one first, then opted-in ones
+        :param service_tokens: list of service access tokens of the application
+        """
+
+        user_tokens = list(dict.fromkeys(user_tokens))
+        self._slots = [_TokenSlot(token, 'own', self.user_interval) for token in user_tokens[:1]]
+        self._slots += [_TokenSlot(token, 'user', self.user_interval) for token in user_tokens[1:]]
+        self._slots += [_TokenSlot(token, 'service', self.service_interval) for token in dict.fromkeys(service_tokens)]
+        self._condition = threading.Condition()
+
+    def size(self, method):
+        """Returns number of working tokens allowed to call the method"""
+
+        with self._condition:
+            return sum(1 for slot in self._slots if self._is_usable(slot, method))
+
+    def _is_usable(self, slot, method):
+        if slot.disabled:
+            return False
+        if method in self.viewer_methods:
+            return slot.kind == 'own'
+        return slot.kind != 'service' or method not in self.user_only_methods
+
+    def _acquire(self, method, deadline):
+        """Waits for a free token allowed to call the method and for its rate budget,
+        fails if all such tokens are disabled or the method cools down with them past the deadline
+        """
+
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                usable = [slot for slot in self._slots if self._is_usable(slot, method)]
+                ready = [slot for slot in usable if slot.cooling_until.get(method, 0) <= now]
+                if not ready:
+                    cooled_at = min((slot.cooling_until[method] for slot in usable), default=None)
+                    if cooled_at is None or cooled_at > deadline:
+                        raise ApiRequestError('Нет доступных токенов ВК для метода ' + method)
+                    self._condition.wait(cooled_at - now)
+                    continue
+                free = [slot for slot in ready if not slot.busy]
+                if free:
+                    slot = min(free, key=lambda s: s.available_at)
+                    slot.busy = True
+                    break
+                self._condition.wait()
+        delay = slot.available_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        slot.available_at = time.monotonic() + slot.interval
+        return slot
+
+    def _release(self, slot, method, error_code=None):
+        with self._condition:
+            slot.busy = False
+            self._apply_error(slot, method, error_code)
+            self._condition.notify_all()
+
+    def _apply_error(self, slot, method, error_code):
+        if error_code in self.disabling_error_codes:
+            slot.disabled = True
+        elif error_code in self.cooling_error_codes:
+            slot.cooling_until[method] = time.monotonic() + self.cooling_error_codes[error_code]
+
+    def report_errors(self, vk_session, method, errors):
+        """Updates the state of the token by errors of the requests inside its execute call
+        :param vk_session: session given by the pool to func
+        :param method: VK API method of the requests
+        :param errors: list of error dicts of the execute response
+        """
+
+        with self._condition:
+            for slot in self._slots:
+                if slot.session is vk_session:
+                    for error in errors:
+                        self._apply_error(slot, method, error.get('error_code'))
+                    self._condition.notify_all()
+
+    def _call(self, method, func, value):
+        deadline = time.monotonic() + self.max_wait
+        for attempt in range(self.max_attempts):
+            slot = self._acquire(method, deadline)
+            failure = None
+            try:
+                return func(slot.session, value)
+            except vk_api.ApiError as error:
+                failure = error.code
+                if attempt + 1 == self.max_attempts or not self.is_token_error(error):
+                    raise ApiRequestError(error)
+            except (vk_api.VkApiError, requests.RequestException) as error:
+                raise ApiRequestError(error)
+            finally:
+                self._release(slot, method, failure)
+
+    @classmethod
+    def is_token_error(cls, error):
+        """Checks whether the error is caused by the token state and the request may succeed with another token"""
+
+        return error.code in cls.disabling_error_codes or error.code in cls.cooling_error_codes
+
+    def map(self, method, func, values, skip_failed=False):
+        """Calls func(vk_session, value) for each of values, spreading the calls between tokens
+        :param method: VK API method called by func, restricts the tokens used
+        :param func: function sending requests with the given session
+        :param values: list of arguments for func
+        :param skip_failed: whether a failed call gives None instead of stopping the iteration
+        :return: iterator over results of func in the order of values,
+            raises ApiRequestError if a call fails with all of the tokens
+        """
+
+        def call(value):
+            try:
+                return self._call(method, func, value)
+            except ApiRequestError:
+                if skip_failed:
+                    return None
+                raise
+
+        workers = self.size(method)
+        if not workers:
+            raise ApiRequestError('Нет действующих токенов ВК для метода ' + method)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(call, values)
@@ -3,24 +3,160 @@ from itertools import islice
 
 from pyvis.network import Network
 
+from .clustering import get_clusters, aggregate_edges, split_edges
+from .snapshot import save_snapshot
+
+# above this number of friends nodes are drawn as plain dots instead of avatars
+AVATARS_MAX_NODES = 300
+# above this number of friends the graph is drawn as clusters of friends, expanded on demand
+CLUSTERING_MIN_NODES = 1000
+
 
 class SocialGraph:
 
-    def __init__(self, user, friend_uids, mutual, gifts, likes, comments):
+    def __init__(self, user, friend_uids, mutual, gifts, likes, comments, friends=None,
+                 avatars_max_nodes=AVATARS_MAX_NODES, clustering_min_nodes=CLUSTERING_MIN_NODES):
         self.user = user
         self.mutual = mutual
         self.friend_uids = friend_uids
-        self.graph = self._get_graph()
-        self.gifts = self._get_edges_from_metrics(gifts)
-        self.likes = self._get_edges_from_metrics(likes)
-        self.comments = self._get_edges_from_metrics(comments)
+        self.metrics = {'gifts': gifts, 'likes': likes, 'comments': comments}
+        self.avatars_max_nodes = avatars_max_nodes
+        self.clustering_min_nodes = clustering_min_nodes
+        self.friends = friends if friends is not None else self.user.friends.get('items')
+        self.titles = self._get_titles()
+        self.cluster_of = self._get_cluster_of()
+        mutual_edges = self._get_mutual_edges()
+        metric_edges = {layer: self._get_metric_edges(metric) for layer, metric in self.metrics.items()}
+        self.graph = self._get_graph(mutual_edges)
+        self.gifts = self._get_edges(metric_edges['gifts'], directed=True)
+        self.likes = self._get_edges(metric_edges['likes'], directed=True)
+        self.comments = self._get_edges(metric_edges['comments'], directed=True)
         self.close_friends = self._get_close_friends()
+        self.clusters = self._get_clusters()
+        self.cluster_edges = {'mutual': split_edges(mutual_edges, self.cluster_of)}
+        self.cluster_edges.update(
+            (layer, split_edges(edges, self.cluster_of)) for layer, edges in metric_edges.items()
+        )
+
+    @classmethod
+    def from_snapshot(cls, user, snapshot, **kwargs):
+        """Builds the graph from GraphSnapshot without requests to the API,
+        friends are drawn as they were when the snapshot was written
+        """
+
+        friends = [
+            {'id': node['id'], 'first_name': node['first_name'], 'last_name': node['last_name'],
+             'photo_200': node['image']}
+            for node in snapshot.get_nodes()[1:]
+        ]
+        return cls(user, snapshot.friend_uids, snapshot.get_mutual(), snapshot.get_metric('gifts'),
+                   snapshot.get_metric('likes'), snapshot.get_metric('comments'), friends, **kwargs)
+
+    def export_snapshot(self, path):
+        """Writes binary snapshot of the graph, see snapshot.load_snapshot"""
+
+        nodes = [{
+            'id': int(self.user.uid),
+            'first_name': self.user.first_name,
+            'last_name': self.user.last_name,
+            'image': self.user.image_url,
+        }]
+        nodes.extend({
+            'id': int(value.get('id') or value.get('uid')),
+            'first_name': value.get('first_name'),
+            'last_name': value.get('last_name'),
+            'image': value.get('photo_200') or value.get('pic190x190'),
+        } for value in self.friends)
+        save_snapshot(path, nodes, self.mutual, **self.metrics)
+
+    def _get_titles(self):
+        """Returns full names of the user and his friends by their ids"""
+
+        titles = {int(self.user.uid): self.user.first_name + ' ' + self.user.last_name}
+        for value in self.friends:
+            titles[int(value.get('id') or value.get('uid'))] = value.get('first_name') + ' ' + value.get('last_name')
+        return titles
+
+    def _get_cluster_of(self):
+        """Splits friends into communities if there are too many of them to draw each one
+        :return: dict of friends ids and ids of their cluster nodes, empty if clustering is not needed
+        example: {friend_id1: -1, friend_id2: -1, friend_id3: -2, ...}
+        """
+
+        if len(self.friends) < self.clustering_min_nodes:
+            return {}
+        uids = list(int(value.get('id') or value.get('uid')) for value in self.friends)
+        return {
+            uid: -(i + 1)
+            for i, members in enumerate(get_clusters(uids, self.mutual)) for uid in members
+        }
+
+    def _get_mutual_edges(self):
+        """Returns edges of the mutual friends graph, the weight is the number of mutual friends of the ends
+        example: [(friend_id1, friend_id2, weight), ..., (uid, friend_id1, weight), ...]
+        """
+
+        mutual_sets = {int(uid): set(int(friend) for friend in mutuals or []) for uid, mutuals in self.mutual.items()}
+        edges = []
+        seen = set()
+        for friend1, mutuals in mutual_sets.items():
+            for friend2 in mutuals:
+                key = (min(friend1, friend2), max(friend1, friend2))
+                if friend1 in self.titles and friend2 in self.titles and key not in seen:
+                    seen.add(key)
+                    edges.append((friend1, friend2, len(mutuals & mutual_sets[friend2]) if friend2 in mutual_sets else 0))
+        for friend in self.friend_uids:
+            edges.append((int(self.user.uid), int(friend), len(mutual_sets.get(int(friend), ()))))
+        return edges
+
+    def _get_metric_edges(self, metric):
+        """Returns edges of interactions from the sender to the receiver
+        example: [(friend_id2, friend_id1, weight), ...]
+        """
+
+        edges = []
+        for friend1 in metric:
+            for friend2 in metric[friend1]:
+                if metric[friend1][friend2] > 0 and int(friend1) in self.titles and int(friend2) in self.titles:
+                    edges.append((int(friend2), int(friend1), metric[friend1][friend2]))
+        return edges
+
+    def _get_edges(self, edges, directed):
+        """Returns vis.js edges between the drawn nodes, edges between clusters are summed"""
+
+        titles = self.titles
+        if self.cluster_of:
+            edges = aggregate_edges(edges, self.cluster_of, directed)
+            titles = {**titles, **{cluster_id: 'Группа друзей (' + str(size) + ')'
+                                   for cluster_id, size in self._get_cluster_sizes().items()}}
+        vis_edges = []
+        for source, target, value in edges:
+            by_user = int(self.user.uid) in (source, target)
+            edge = {
+                'from': source,
+                'to': target,
+                'value': value,
+                'color': '#FF7092' if by_user else '#007bff',
+                'title': 'от: ' + titles[source] + '\nк:   ' + titles[target]
+            }
+            if directed:
+                edge['arrows'] = 'middle' if by_user else 'to'
+            vis_edges.append(edge)
+        return vis_edges
+
+    def _get_cluster_sizes(self):
+        sizes = {}
+        for cluster_id in self.cluster_of.values():
+            sizes[cluster_id] = sizes.get(cluster_id, 0) + 1
+        return sizes
+
+    def _get_graph(self, mutual_edges):
+        """Builds the drawn graph: the user and either his friends or clusters of friends"""
 
-    def _get_graph(self):
         graph = Network(
             heading='Social graph of friends')
 
-        friends = self.user.friends
+        with_avatars = len(self.friends) <= self.avatars_max_nodes
         graph.add_node(
             int(self.user.uid),
             shape="circularImage",
@@ -32,36 +168,31 @@ class SocialGraph:
             image=self.user.image_url
         )
 
-        for value in friends.get('items'):
-            graph.add_node(
-                int(value.get('id') or value.get('uid')),
-                shape="circularImage",
-                label=value.get('last_name'),
-                title=value.get('first_name') + ' ' + value.get('last_name'),
-                color='#007bff',
-                size=35,
-                mas=4,
-                image=value.get('photo_200') or value.get('pic190x190')
-            )
-            
-        for friend1, mutuals in self.mutual.items():
-            if mutuals:
-                for friend2 in mutuals:
-                    graph.add_edge(
-                        int(friend1),
-                        int(friend2),
-                        color='#007bff',
-                        value=len(list(set(self.mutual[friend1]) & set(self.mutual[friend2]))) if friend2 in self.mutual else 0,
-                        title='от: ' + graph.get_node(int(friend1))['title'] + '\nк:   ' + graph.get_node(int(friend2))['title']
-                    )
-        for friend in self.friend_uids:
-            graph.add_edge(
-                int(self.user.uid),
-                int(friend),
-                color='#FF7092',
-                value=len(self.mutual[friend]) if friend in self.mutual else 0,
-                title='от: ' + graph.get_node(int(self.user.uid))['title'] + '\nк:   ' + graph.get_node(int(friend))['title']
-            )
+        if self.cluster_of:
+            for cluster_id, size in self._get_cluster_sizes().items():
+                graph.add_node(
+                    cluster_id,
+                    shape="dot",
+                    label=str(size),
+                    title='Группа друзей (' + str(size) + ')',
+                    color='#007bff',
+                    size=min(35 + size // 10, 100)
+                )
+        else:
+            for value in self.friends:
+                graph.add_node(
+                    int(value.get('id') or value.get('uid')),
+                    shape="circularImage" if with_avatars else "dot",
+                    label=value.get('last_name'),
+                    title=value.get('first_name') + ' ' + value.get('last_name'),
+                    color='#007bff',
+                    size=35 if with_avatars else 15,
+                    mas=4,
+                    image=value.get('photo_200') or value.get('pic190x190')
+                )
+
+        for edge in self._get_edges(mutual_edges, directed=False):
+            graph.add_edge(edge['from'], edge['to'], color=edge['color'], value=edge['value'], title=edge['title'])
 
         graph.set_options('''
                 var options = {
@@ -132,32 +263,6 @@ class SocialGraph:
         return graph
 
 
-    def _get_edges_from_metrics(self, metric):
-        edges = []
-        for friend1 in metric:
-            for friend2 in metric[friend1]:
-                if metric[friend1][friend2] > 0:
-                    if self.user.uid == int(friend1) or self.user.uid == int(friend2):
-                        edges.append({
-                            'from': friend2,
-                            'to': friend1,
-                            'arrows': 'middle',
-                            'value': metric[friend1][friend2],
-                            'color': '#FF7092',
-                            'title': 'от: ' + self.graph.get_node(int(friend2))['title'] + '\nк:   ' + self.graph.get_node(int(friend1))['title']
-                            })
-                    else:
-                        edges.append({
-                            'from': friend2,
-                            'to': friend1,
-                            'arrows': 'to',
-                            'value': metric[friend1][friend2],
-                            'color': '#007bff',
-                            'title': 'от: ' + self.graph.get_node(int(friend2))['title'] + '\nк:   ' + self.graph.get_node(int(friend1))['title']
-                            })
-        return edges
-
-
     def _get_close_friends(self):
         close_friends_uids = list(
             uid for uid, _ in islice(
@@ -168,7 +273,25 @@ class SocialGraph:
                 lambda u:
                 u.get('id') in close_friends_uids if u.get('id')
                 else int(u.get('uid')) in close_friends_uids,
-                self.user.friends.get('items')
+                self.friends
             )
         )
-        return close_friends
\ No newline at end of file
+        return close_friends
+
+
+    def _get_clusters(self):
+        """Returns friends of each cluster to draw them when the cluster is expanded
+        example: {-1: [[friend_id1, last name, full name, avatar], ...], -2: [...], ...}
+        """
+
+        clusters = {}
+        for value in self.friends:
+            uid = int(value.get('id') or value.get('uid'))
+            if uid in self.cluster_of:
+                clusters.setdefault(self.cluster_of[uid], []).append([
+                    uid,
+                    value.get('last_name'),
+                    self.titles[uid],
+                    value.get('photo_200') or value.get('pic190x190'),
+                ])
+        return clusters
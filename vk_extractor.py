@@ -9,8 +9,10 @@ import requests
 import vk_api
 from .decorators import force
 from .exceptions import UserIdError, ApiRequestError
+from .token_pool import TokenPool
 from . import settings
 import copy
+import time
 
 
 @force
@@ -86,52 +88,177 @@ def get_friends_list(token, uid):
     return friends
 
 
-def get_mutual_friends(token, source_uid, target_uids):
+def get_friends_lists(vk_session, uids):
+    """Return responses from vk api friends.get for several users in one execute request
+
+    :param vk_session: vk_api session
+    :param uids: list of up to 25 users ids
+    :return: dict with pairs of user id - friends list and dict with pairs of user id - error of the request,
+        users with private or deleted pages get into the errors
+
+    example: {uid: {'count': 2, 'items': [{'id': 213412, 'first_name': ..., 'last_name': ...}, ...]}}, {}
+
+    """
+
+    return vk_api.vk_request_one_param_pool(
+        vk_session,
+        'friends.get',
+        key='user_id',
+        values=uids,
+        default_values={'fields': 'photo_200', 'v': settings.api_v}
+        )
+
+
+def get_mutual_friends(token, source_uid, target_uids, token_pool=None):
     """Returns mutual friends of the given user and target users
 
     :param token: access token
     :param source_uid: source user id
     :param target_uids: list of users to find mutual friends
+    :param token_pool: pool of tokens to spread requests between, by default only token is used
     :return: dictionary with pairs of user id - list of mutual friends ids
 
     example: {friend id: [mutual id 1, mutual id 2, ...]}
     """
 
-    vk_session = vk_api.VkApi(token=token)
-    vk = vk_session.get_api()
+    fetcher = MutualFriendsFetcher(token, source_uid, target_uids, token_pool=token_pool)
+    mutual_friends = fetcher.fetch()
+    if fetcher.failed_uids and not mutual_friends:
+        raise ApiRequestError('Не удалось получить общих друзей')
+    return mutual_friends
+
+
+class MutualFriendsFetcher:
+    """Class for fetching mutual friends batch by batch with retries of failed batches"""
+
+    batch_size = 100  # friends.getMutual accepts up to 100 target_uids
+    pool_size = 25  # VkRequestsPool sends up to 25 requests in one execute call
+
+    def __init__(self, token, source_uid, target_uids, mutual_friends=None, retries=3, backoff=1, token_pool=None):
+        """
+        :param token: access token
+        :param source_uid: source user id
+        :param target_uids: list of users to find mutual friends
+        :param mutual_friends: already fetched mutual friends, users from it are not requested again
+        :param retries: number of additional attempts for failed batches
+        :param backoff: delay in seconds before the first retry, doubles with each next retry
+        :param token_pool: pool of tokens to spread requests between, by default only token is used
+        """
+
+        self.token = token
+        self.token_pool = token_pool or TokenPool([token])
+        self.source_uid = source_uid
+        self.target_uids = target_uids
+        self.mutual_friends = {int(uid): friends for uid, friends in (mutual_friends or {}).items()}
+        self.retries = retries
+        self.backoff = backoff
+        self.failed_uids = []
+
+    def __iter__(self):
+        """Sends requests and yields mutual friends fetched by every completed execute call
+        example: {friend id: [mutual id 1, mutual id 2, ...]}
+        """
+
+        pending = [uid for uid in self.target_uids if uid not in self.mutual_friends]
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        for attempt in range(self.retries + 1):
+            if not batches:
+                break
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            failed_batches = []
+            pools = [batches[i:i + self.pool_size] for i in range(0, len(batches), self.pool_size)]
+            completed = 0
+            try:
+                for results in self.token_pool.map('friends.getMutual', self._send_pool, pools):
+                    completed += 1
+                    fetched = {}
+                    for batch, mutual_friends in results:
+                        if mutual_friends is None:
+                            failed_batches.append(batch)
+                        else:
+                            fetched.update(mutual_friends)
+                    if fetched:
+                        self.mutual_friends.update(fetched)
+                        yield fetched
+            except ApiRequestError:
+                # no token could complete the call, the rest is left for the next attempt
+                failed_batches.extend(batch for pool in pools[completed:] for batch in pool)
+            batches = failed_batches
+        self.failed_uids = [uid for batch in batches for uid in batch]
+
+    def _send_pool(self, vk_session, batches):
+        """Method for sending friends.getMutual requests for several batches in one execute call
+        :return: list of pairs of batch - dict of mutual friends, or None if the request failed
+        """
 
-    uids_batches = [target_uids[i:i + 100] for i in range(0, len(target_uids), 100)]
-    friends_bathes = {}
-    with vk_api.VkRequestsPool(vk_session) as pool:
-        for i in range(len(uids_batches)):
-            friends_bathes[i] = pool.method('friends.getMutual', {
-                'source_uid': source_uid,
-                'target_uids': uids_batches[i],
-                'v': settings.api_v
-            })
-    mutual_friends = {}
-    for key, value in friends_bathes.items():
+        requests_batches = {}
         try:
-            friends_bathes[key] = value.result
-            [mutual_friends.update({int(friend['id']): friend['common_friends']}) for friend in friends_bathes[key]]
-        except vk_api.VkRequestsPoolException as error:
-            raise ApiRequestError(error)
-    return mutual_friends
+            with vk_api.VkRequestsPool(vk_session) as pool:
+                for i, batch in enumerate(batches):
+                    requests_batches[i] = pool.method('friends.getMutual', {
+                        'source_uid': self.source_uid,
+                        'target_uids': batch,
+                        'v': settings.api_v
+                    })
+        except vk_api.ApiError as error:
+            if TokenPool.is_token_error(error):
+                raise
+            return [(batch, None) for batch in batches]
+        except (vk_api.VkApiError, requests.RequestException):
+            return [(batch, None) for batch in batches]
+
+        results = []
+        for i, batch in enumerate(batches):
+            try:
+                response = requests_batches[i].result
+            except vk_api.VkRequestsPoolException as error:
+                self.token_pool.report_errors(vk_session, 'friends.getMutual', [error.error])
+                results.append((batch, None))
+                continue
+            mutual_friends = {uid: [] for uid in batch}
+            for friend in response:
+                mutual_friends[int(friend['id'])] = friend['common_friends']
+            results.append((batch, mutual_friends))
+        return results
+
+    def fetch(self):
+        """Fetches all mutual friends, users of batches failed after all retries are left out
+        :return: dictionary with pairs of user id - list of mutual friends ids
+        """
+
+        for _ in self:
+            pass
+        return self.mutual_friends
+
+    @property
+    def coverage(self):
+        """Report on which part of target users has mutual friends fetched
+        example: {'total': 250, 'fetched': 200, 'failed': [friend_id1, ..., friend_id50]}
+        """
+
+        return {
+            'total': len(self.target_uids),
+            'fetched': sum(1 for uid in self.target_uids if uid in self.mutual_friends),
+            'failed': list(self.failed_uids),
+        }
 
 
 class FriendsStatistics:
     """Class for collecting statistics about the interaction of friends"""
 
-    def __init__(self, token, uid, friends_ids, active_friends_ids):
+    def __init__(self, token, uid, friends_ids, active_friends_ids, token_pool=None):
         """
         :param token: access token
         :param uid: user id
         :param friends_ids: list of user's friends IDs
         :param active_friends_ids: list of non-deactivated and non-closed user's friends IDs
         :param mutual_friends: dictionary of IDs of the user's friends and friends common with him and a friend
+        :param token_pool: pool of tokens to spread requests between, by default only token is used
         """
         
         self.token = token
+        self.token_pool = token_pool or TokenPool([token])
         self.uid = uid
         self.friends_ids = copy.deepcopy(friends_ids)
         self.friends_ids.append(uid)
@@ -182,9 +309,7 @@ class FriendsStatistics:
         param key: key for request dict, is name of one of parameters for request
         """
 
-        vk_session = vk_api.VkApi(token=self.token)
-        responses = {}
-        for batch in self.uids_batches:
+        def send_batch(vk_session, batch):
             response, errors = vk_api.vk_request_one_param_pool(
                         vk_session,
                         method,
@@ -192,9 +317,40 @@ class FriendsStatistics:
                         values=batch,
                         default_values=default_values
                         )
-            responses.update(response)
+            self.token_pool.report_errors(vk_session, method, errors.values())
+            return response
+
+        responses = {}
+        # like errors of single requests, batches failed with all tokens are left out of the statistics
+        for response in self.token_pool.map(method, send_batch, self.uids_batches, skip_failed=True):
+            if response is not None:
+                responses.update(response)
         return responses
 
+    def _send_vk_requests_posts_pool(self, method, key, **default_values):
+        """Sends requests about the collected posts of each friend, spreading friends between tokens of the pool
+        param method: VK API method
+        param key: key for request dict, is name of the parameter for post id
+        :return: list of pairs of friend id - responses for his posts
+        """
+
+        def send_posts(vk_session, friend_id):
+            wall = self.walls[friend_id]['items']
+            posts_ids = [wall[i]['id'] for i in range(len(wall))]
+            response, errors = vk_api.vk_request_one_param_pool(
+                vk_session,
+                method,
+                key=key,
+                values=posts_ids,
+                default_values=dict(default_values, owner_id=friend_id)
+                )
+            self.token_pool.report_errors(vk_session, method, errors.values())
+            return friend_id, response
+
+        friends_with_posts = [friend_id for friend_id in self.walls if self.walls[friend_id]['items']]
+        responses = self.token_pool.map(method, send_posts, friends_with_posts, skip_failed=True)
+        return (response for response in responses if response is not None)
+
     def get_gifts(self):
         """Method for collecting data about friends' gifts
         :return: completed dict of incidents
@@ -222,21 +378,11 @@ class FriendsStatistics:
         example: {uid : {{friend_id1: weight_1}, {friend_id2: weight_2}, ..., {uid: weight_3}}, friend_id2 : {{friend_id3: weight_4}, ..., {uid: weight_5}}, ...}
         """
 
-        vk_session = vk_api.VkApi(token=self.token)
-
+        likes = self._send_vk_requests_posts_pool('likes.getList', 'item_id',
+                type='post', filter='likes', count=100, v=settings.api_v)
         friends_likes = {}
-        for friend_id in self.walls:
-            wall = self.walls[friend_id]['items']
-            posts_ids = [wall[i]['id'] for i in range(len(wall))]
-            if len(posts_ids) > 0:
-                likes_of_posts, errors_likes = vk_api.vk_request_one_param_pool(
-                    vk_session,
-                    'likes.getList',
-                    key='item_id',
-                    values=posts_ids,
-                    default_values={'owner_id': friend_id, 'type': 'post', 'filter': 'likes', 'count': 100, 'v': settings.api_v}
-                    )
-                self._filling_stats(likes_of_posts, friends_likes, friend_id)
+        for friend_id, likes_of_posts in likes:
+            self._filling_stats(likes_of_posts, friends_likes, friend_id)
         return friends_likes
 
     def get_comments(self):
@@ -245,19 +391,9 @@ class FriendsStatistics:
         example: {uid : {{friend_id1: weight_1}, {friend_id2: weight_2}, ..., {uid: weight_3}}, friend_id2 : {{friend_id3: weight_4}, ..., {uid: weight_5}}, ...}
         """
 
-        vk_session = vk_api.VkApi(token=self.token)
-
+        comments = self._send_vk_requests_posts_pool('wall.getComments', 'post_id',
+                count=100, preview_length=1, v=settings.api_v)
         friends_comments = {}
-        for friend_id in self.walls:
-            wall = self.walls[friend_id]['items']
-            posts_ids = [wall[i]['id'] for i in range(len(wall))]
-            if len(posts_ids) > 0:
-                comments_of_posts, errors_comments = vk_api.vk_request_one_param_pool(
-                    vk_session,
-                    'wall.getComments',
-                    key='post_id',
-                    values=posts_ids,
-                    default_values={'owner_id': friend_id,  'count': 100, 'preview_length': 1, 'v': settings.api_v}
-                    )
-                self._filling_stats(comments_of_posts, friends_comments, friend_id)
+        for friend_id, comments_of_posts in comments:
+            self._filling_stats(comments_of_posts, friends_comments, friend_id)
         return friends_comments
\ No newline at end of file